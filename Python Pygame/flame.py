@@ -1,6 +1,7 @@
 import pygame
 import os
 import random
+import math
 
 pygame.init()
 
@@ -14,24 +15,71 @@ pygame.display.set_caption('Flame Particles using Pygame')
 
 FPS = 60
 
+# 'sprites' draws a glow sprite for every particle
+# 'heat' accumulates the particles into a heat buffer and colors it in a single pass (uses numpy)
+# press M to switch between them
+RENDER_MODE = 'sprites'
+HEAT_FIELD = True  # set it to False if numpy is not available
+
+if HEAT_FIELD:
+    import numpy
+
 clock = pygame.time.Clock()
 
 
+def get_flame_color(r):
+    if r == 4 or r == 3:
+        return 255, 0, 0
+    elif r == 2:
+        return 255, 150, 0
+    else:
+        return 50, 50, 50
+    # return 0, 0, 255  # return this instead to make the flame blue
+
+
+# pre-rendered glow sprites, keyed by (r, alpha_layers, alpha_glow)
+glow_cache = {}
+
+
+def get_glow_surf(r, alpha_layers, alpha_glow):
+    key = (r, alpha_layers, alpha_glow)
+    if key in glow_cache:
+        return glow_cache[key]
+    max_surf_size = 2 * r * alpha_layers * alpha_layers * alpha_glow
+    surf = pygame.Surface((max_surf_size, max_surf_size), pygame.SRCALPHA)
+    for i in range(alpha_layers, -1, -1):
+        alpha = 255 - i * (255 // alpha_layers - 5)
+        if alpha <= 0:
+            alpha = 0
+        radius = r * i * i * alpha_glow
+        color = (*get_flame_color(r), alpha)
+        pygame.draw.circle(surf, color, (surf.get_width() // 2, surf.get_height() // 2), radius)
+    glow_cache[key] = surf
+    return surf
+
+
 class FlameParticle:
     alpha_layer_qty = 2
     alpha_glow_difference_constant = 2
 
     def __init__(self, x=SCREEN_WIDTH // 2, y=SCREEN_HEIGHT // 2, r=5):
+        self.alpha_layers = FlameParticle.alpha_layer_qty
+        self.alpha_glow = FlameParticle.alpha_glow_difference_constant
+        self.respawn(x, y, r)
+
+    def respawn(self, x, y, r):
+        # resets the particle in place so that dead particles can be recycled
         self.x = x
         self.y = y
         self.r = r
         self.original_r = r
-        self.alpha_layers = FlameParticle.alpha_layer_qty
-        self.alpha_glow = FlameParticle.alpha_glow_difference_constant
-        max_surf_size = 2 * self.r * self.alpha_layers * self.alpha_layers * self.alpha_glow
-        self.surf = pygame.Surface((max_surf_size, max_surf_size), pygame.SRCALPHA)
+        self.surf = get_glow_surf(self.r, self.alpha_layers, self.alpha_glow)
         self.burn_rate = 0.1 * random.randint(1, 4)
 
+    @property
+    def alive(self):
+        return self.original_r > 0
+
     def update(self):
         self.y -= 7 - self.r
         self.x += random.randint(-self.r, self.r)
@@ -41,52 +89,133 @@ class FlameParticle:
             self.r = 1
 
     def draw(self):
-        max_surf_size = 2 * self.r * self.alpha_layers * self.alpha_layers * self.alpha_glow
-        self.surf = pygame.Surface((max_surf_size, max_surf_size), pygame.SRCALPHA)
-        for i in range(self.alpha_layers, -1, -1):
-            alpha = 255 - i * (255 // self.alpha_layers - 5)
-            if alpha <= 0:
-                alpha = 0
-            radius = self.r * i * i * self.alpha_glow
-            if self.r == 4 or self.r == 3:
-                r, g, b = (255, 0, 0)
-            elif self.r == 2:
-                r, g, b = (255, 150, 0)
-            else:
-                r, g, b = (50, 50, 50)
-            # r, g, b = (0, 0, 255)  # uncomment this to make the flame blue
-            color = (r, g, b, alpha)
-            pygame.draw.circle(self.surf, color, (self.surf.get_width() // 2, self.surf.get_height() // 2), radius)
+        # the glow only depends on the radius, so the pre-rendered sprite is reused
+        self.surf = get_glow_surf(self.r, self.alpha_layers, self.alpha_glow)
         screen.blit(self.surf, self.surf.get_rect(center=(self.x, self.y)))
 
 
 class Flame:
-    def __init__(self, x=SCREEN_WIDTH // 2, y=SCREEN_HEIGHT // 2):
+    def __init__(self, x=SCREEN_WIDTH // 2, y=SCREEN_HEIGHT // 2, flame_intensity=2):
         self.x = x
         self.y = y
-        self.flame_intensity = 2
-        self.flame_particles = []
-        for i in range(self.flame_intensity * 25):
-            self.flame_particles.append(FlameParticle(self.x + random.randint(-5, 5), self.y, random.randint(1, 5)))
+        self.flame_intensity = flame_intensity
+        # fixed capacity pool, dead particles are respawned in their own slot
+        self.flame_particles = [FlameParticle(*self.spawn_args()) for _ in range(self.flame_intensity * 25)]
+        self.respawned = 0  # number of particles recycled in the last frame
+
+    def spawn_args(self):
+        return self.x + random.randint(-5, 5), self.y, random.randint(1, 5)
+
+    @property
+    def capacity(self):
+        return len(self.flame_particles)
+
+    @property
+    def live_count(self):
+        return sum(1 for i in self.flame_particles if i.alive)
+
+    @property
+    def dead_count(self):
+        return self.capacity - self.live_count
 
-    def draw_flame(self):
+    def draw_flame(self, heat_field=None):
+        self.respawned = 0
         for i in self.flame_particles:
-            if i.original_r <= 0:
-                self.flame_particles.remove(i)
-                self.flame_particles.append(FlameParticle(self.x + random.randint(-5, 5), self.y, random.randint(1, 5)))
-                del i
+            if not i.alive:
+                i.respawn(*self.spawn_args())
+                self.respawned += 1
                 continue
             i.update()
-            i.draw()
+            if not heat_field:
+                i.draw()
+        if heat_field:
+            n = len(self.flame_particles)
+            values = numpy.fromiter((v for i in self.flame_particles for v in (i.x, i.y, i.r)), float, 3 * n)
+            heat_field.splat(*values.reshape(n, 3).T)
+
+
+class HeatField:
+    # every particle adds its radius as heat to one low resolution uint16 buffer,
+    # the buffer is blurred once into glows and a palette turns the heat into colors,
+    # so after the splat the cost depends on the screen area and not on the number of particles
+    max_heat = 255
+
+    def __init__(self, width=SCREEN_WIDTH, height=SCREEN_HEIGHT, downscale=4, radius=3):
+        self.downscale = downscale
+        self.radius = radius  # glow radius in heat cells
+        w, h = self.size = (width // downscale, height // downscale)
+        self.heat = numpy.zeros(self.size, dtype=numpy.uint16)
+        # scratch arrays for the blur, padded so the moving sums need no bounds checks
+        size = 2 * radius + 1
+        self.padded = numpy.zeros((w + size, h + size), dtype=numpy.int32)
+        self.sums = numpy.zeros_like(self.padded)
+        self.glow = numpy.zeros(self.size, dtype=numpy.int32)
+        self.pixels = numpy.zeros(self.size, dtype=numpy.uint8)
+        # the heat is an index into the palette, an 8 bit surface shows the indices as colors
+        self.surf = pygame.Surface(self.size, depth=8)
+        self.surf.set_palette(self.get_palette())
+        self.color_surf = pygame.Surface(self.size)
+        self.screen_surf = pygame.Surface((width, height))
+
+    def get_palette(self):
+        # little heat is the grey of the small particles, more turns orange and the most turns red,
+        # like FlameParticle.draw picks the color by radius, and it fades in like stacked alpha layers
+        bands = [(0, get_flame_color(1)), (6, get_flame_color(1)), (16, get_flame_color(2)), (40, get_flame_color(3))]
+        palette = []
+        for heat in range(256):
+            for (start, color), (end, next_color) in zip(bands, bands[1:]):
+                if heat <= end:
+                    break
+            t = min(1, (heat - start) / (end - start))
+            coverage = 1 - math.exp(-heat / 12)
+            palette.append([int((a + (b - a) * t) * coverage) for a, b in zip(color, next_color)])
+        return palette
+
+    def clear(self):
+        self.heat.fill(0)
+
+    def splat(self, x, y, r):
+        # x, y and r are arrays with a value for every particle
+        x = (x // self.downscale).astype(int)
+        y = (y // self.downscale).astype(int)
+        inside = (x >= 0) & (x < self.size[0]) & (y >= 0) & (y < self.size[1])
+        numpy.add.at(self.heat, (x[inside], y[inside]), r[inside].astype(numpy.uint16))
+
+    def blur(self):
+        # moving sum of the heat over a (2 * radius + 1) square, one cumulative sum per axis
+        w, h = self.size
+        size = 2 * self.radius + 1
+        padded, sums = self.padded, self.sums
+        padded[self.radius + 1:self.radius + 1 + w, self.radius + 1:self.radius + 1 + h] = self.heat
+        numpy.cumsum(padded, axis=0, out=sums)
+        numpy.subtract(sums[size:, :], sums[:-size, :], out=padded[:w, :])
+        numpy.cumsum(padded[:w, :], axis=1, out=sums[:w, :])
+        numpy.subtract(sums[:w, size:], sums[:w, :-size], out=self.glow)
+        # the padded border was overwritten, it is zeroed again for the next frame
+        padded[:w, :].fill(0)
+
+    def draw(self, surf: pygame.Surface):
+        self.blur()
+        numpy.minimum(self.glow, self.max_heat, out=self.glow)
+        self.pixels[...] = self.glow
+        pygame.surfarray.blit_array(self.surf, self.pixels)
+        self.color_surf.blit(self.surf, (0, 0))
+        pygame.transform.smoothscale(self.color_surf, self.screen_surf.get_size(), self.screen_surf)
+        surf.blit(self.screen_surf, (0, 0), special_flags=pygame.BLEND_RGB_ADD)
 
 
 flame = Flame()
+heat_field = HeatField() if HEAT_FIELD else None
 
 
 def check_events(events):
+    global RENDER_MODE
     for e in events:
         if e.type == pygame.QUIT:
             quit()
+        if e.type == pygame.KEYDOWN:
+            if e.key == pygame.K_m and heat_field:
+                RENDER_MODE = 'heat' if RENDER_MODE == 'sprites' else 'sprites'
 
 
 def main_window():
@@ -94,9 +223,16 @@ def main_window():
         events = pygame.event.get()
         check_events(events)
         screen.fill((0, 0, 0))
-        flame.draw_flame()
+        if RENDER_MODE == 'heat' and heat_field:
+            heat_field.clear()
+            flame.draw_flame(heat_field)
+            heat_field.draw(screen)
+        else:
+            flame.draw_flame()
         pygame.display.update()
         clock.tick(FPS)
+        pygame.display.set_caption(f'Flame Particles using Pygame FPS = {int(clock.get_fps())} '
+                                   f'live = {flame.live_count} recycled = {flame.respawned}')
 
 
 main_window()
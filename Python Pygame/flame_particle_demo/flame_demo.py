@@ -8,6 +8,12 @@ import pygame
 import sys
 import random
 import math
+import operator
+import hashlib
+import os
+import zipfile
+
+import numpy
 
 pygame.init()
 
@@ -24,6 +30,33 @@ FPS = 60
 
 TARGET_FPS = 60
 
+# stores every flame's particles in shared numpy arrays instead of FlameParticle objects
+# set it to False to use the original object based particles
+USE_NUMPY_ENGINE = True
+
+# how the extracted points are thinned out before flames are placed on them
+# 'nth'     - keeps every POINT_SPACING-th point from top to bottom (the original behaviour)
+# 'grid'    - keeps one point per POINT_SPACING x POINT_SPACING cell
+# 'poisson' - keeps points that are at least POINT_SPACING pixels apart
+# 'target'  - keeps TARGET_POINT_COUNT points spread evenly from top to bottom
+POINT_DECIMATION_MODE = 'nth'
+POINT_SPACING = 4
+TARGET_POINT_COUNT = 3000
+
+# scales the number of active particles to hold TARGET_FPS
+USE_GOVERNOR = True
+LOG_GOVERNOR = True  # prints every change of the particle budget
+
+# only the parts of the screen touched by the flames are updated, in cells of this size
+# it has to be at least as big as the biggest glow sprite
+DIRTY_CELL_SIZE = 32
+
+IMAGE_PATH = 'durga1.png'
+IMAGE_HEIGHT = 720
+ALLOWED_COLORS = ('black', 'red')
+# the final points are cached here, set it to None to extract them on every launch
+POINT_CACHE_FILE = 'durga1.points.npz'
+
 draw_circle = pygame.draw.circle
 new_surface = pygame.Surface
 randint = random.randint
@@ -96,7 +129,296 @@ class Flame:
             i.draw()
 
 
+glow_cache = {}
+
+
+def get_glow_surf(r):
+    # same glow as FlameParticle.draw, rendered once for every radius
+    if r in glow_cache:
+        return glow_cache[r]
+    alpha_layers = FlameParticle.alpha_layer_qty
+    alpha_glow = FlameParticle.alpha_glow_difference_constant
+    max_surf_size = 2 * r * alpha_layers * alpha_layers * alpha_glow
+    surf = new_surface((max_surf_size, max_surf_size), pygame.SRCALPHA)
+    for i in range(alpha_layers, -1, -1):
+        alpha = 255 - i * (255 // alpha_layers - 5)
+        if alpha <= 0:
+            alpha = 0
+        radius = r * i * i * alpha_glow
+        if r == 4 or r == 3:
+            color = (255, 0, 0, alpha)
+        elif r == 2 or r == 1:
+            color = (255, 150, 0, alpha)
+        else:
+            color = (75, 75, 75, alpha)
+        draw_circle(surf, color, (surf.get_width() * 0.5, surf.get_height() * 0.5), radius)
+    glow_cache[r] = surf
+    return surf
+
+
+class FlameParticleSystem:
+    # struct-of-arrays version of Flame + FlameParticle
+    # every flame is an emitter and every particle keeps the index of its emitter
+    max_r = 5
+
+    def __init__(self, capacity=1024):
+        self.rng = numpy.random.default_rng()
+        self.count = 0  # number of particles in use
+        self.flame_count = 0  # number of emitters in use
+        self.x = numpy.zeros(capacity)
+        self.y = numpy.zeros(capacity)
+        self.original_r = numpy.zeros(capacity)
+        self.r = numpy.zeros(capacity, dtype=int)
+        self.burn_rate = numpy.zeros(capacity)
+        self.emitter = numpy.zeros(capacity, dtype=int)
+        self.emitter_x = numpy.zeros(capacity)
+        self.emitter_y = numpy.zeros(capacity)
+
+    def __len__(self):
+        return self.flame_count
+
+    @staticmethod
+    def grow(array, size):
+        if size <= len(array):
+            return array
+        new_array = numpy.zeros(max(size, 2 * len(array)), dtype=array.dtype)
+        new_array[:len(array)] = array
+        return new_array
+
+    def add_flames(self, point_list, flame_intensity=1):
+        # accepts the same [x, y] points that are given to Flame
+        if not len(point_list):
+            return
+        point_list = numpy.asarray(point_list, dtype=float)
+        qty = int(flame_intensity)
+        new_flames = self.flame_count + len(point_list)
+        new_count = self.count + len(point_list) * qty
+        self.emitter_x = self.grow(self.emitter_x, new_flames)
+        self.emitter_y = self.grow(self.emitter_y, new_flames)
+        for name in ['x', 'y', 'original_r', 'r', 'burn_rate', 'emitter']:
+            setattr(self, name, self.grow(getattr(self, name), new_count))
+        self.emitter_x[self.flame_count:new_flames] = point_list[:, 0]
+        self.emitter_y[self.flame_count:new_flames] = point_list[:, 1]
+        self.emitter[self.count:new_count] = numpy.repeat(numpy.arange(self.flame_count, new_flames), qty)
+        self.spawn(numpy.arange(self.count, new_count))
+        self.flame_count = new_flames
+        self.count = new_count
+
+    def remove_flames(self, qty):
+        # removes the last qty flames, their particles are always the last ones in the arrays
+        self.flame_count = max(0, self.flame_count - qty)
+        self.count = int(numpy.searchsorted(self.emitter[:self.count], self.flame_count))
+
+    def thin_flames(self, budget):
+        # lowers the number of particles of the biggest flames until budget particles are left,
+        # every flame keeps at least one particle, so this can stop above the budget
+        n = self.count
+        if n <= budget:
+            return
+        emitter = self.emitter[:n]
+        sizes = numpy.bincount(emitter, minlength=self.flame_count)
+        # particles left for every cap on the particles per flame, the biggest cap that fits is used
+        caps = numpy.arange(1, sizes.max() + 1)
+        left = numpy.minimum(sizes, caps[:, None]).sum(axis=1)
+        cap = caps[max(0, numpy.searchsorted(left, budget, side='right') - 1)]
+        # particles of a flame are next to each other, so a particle's rank in its flame is its distance to the first
+        keep = numpy.arange(n) - numpy.searchsorted(emitter, emitter) < cap
+        self.count = int(keep.sum())
+        for name in ['x', 'y', 'original_r', 'r', 'burn_rate', 'emitter']:
+            array = getattr(self, name)
+            array[:self.count] = array[:n][keep]
+
+    def spawn(self, index):
+        n = len(index)
+        emitter = self.emitter[index]
+        self.x[index] = self.emitter_x[emitter] - 1
+        self.y[index] = self.emitter_y[emitter]
+        self.r[index] = self.rng.integers(1, self.max_r, n, endpoint=True)
+        self.original_r[index] = self.r[index]
+        self.burn_rate[index] = 0.05 * self.rng.integers(1, 8, n, endpoint=True)
+
+    def update(self, dt):
+        n = self.count
+        dead = self.original_r[:n] <= 0
+        alive = ~dead
+        # same rules as FlameParticle.update, but for every live particle at once
+        r = self.r[:n][alive]
+        self.y[:n][alive] -= (7 - r) * dt / 4
+        self.x[:n][alive] += self.rng.integers(-r, r, endpoint=True) * dt * 0.33
+        self.original_r[:n][alive] -= self.burn_rate[:n][alive] * dt
+        self.r[:n] = numpy.maximum(self.original_r[:n].astype(int), 1)
+        # dead particles are respawned at their emitter, like Flame.draw_flame does
+        self.spawn(numpy.flatnonzero(dead))
+
+    def get_sprite_batches(self):
+        # one (sprite, top left positions) pair for every radius in use
+        n = self.count
+        batches = []
+        for r in range(1, self.max_r + 1):
+            selected = self.r[:n] == r
+            if not selected.any():
+                continue
+            img = get_glow_surf(r)
+            w, h = img.get_size()
+            pos = numpy.column_stack([self.x[:n][selected] - w * 0.5, self.y[:n][selected] - h * 0.5])
+            batches.append((img, numpy.floor(pos).astype(int)))
+        return batches
+
+    def draw(self, surf: pygame.Surface):
+        for img, pos in self.get_sprite_batches():
+            surf.blits([(img, p) for p in pos.tolist()], doreturn=False)
+
+
 flames = []
+if USE_NUMPY_ENGINE:
+    flames = FlameParticleSystem()
+
+
+def add_flames(point_list, flame_intensity=1):
+    if USE_NUMPY_ENGINE:
+        flames.add_flames(point_list, flame_intensity)
+        return
+    for p in point_list:
+        flame = Flame(*p)
+        if flame_intensity != flame.flame_intensity:
+            flame.flame_intensity = flame_intensity
+            flame.generate_flame_particles()
+        flames.append(flame)
+
+
+def draw_flames(dt):
+    # returns the (x, y, w, h) box of every particle that was drawn
+    if USE_NUMPY_ENGINE:
+        flames.update(dt)
+        batches = flames.get_sprite_batches()
+        for img, pos in batches:
+            screen.blits([(img, p) for p in pos.tolist()], doreturn=False)
+        boxes = [numpy.column_stack([pos, numpy.tile(img.get_size(), (len(pos), 1))]) for img, pos in batches]
+        return numpy.concatenate(boxes) if boxes else numpy.zeros((0, 4), dtype=int)
+    for i in flames:
+        i.draw_flame(dt)
+    particles = numpy.array([(p.x, p.y, p.r) for i in flames for p in i.flame_particles]).reshape(-1, 3)
+    size = 2 * particles[:, 2] * FlameParticle.alpha_layer_qty ** 2 * FlameParticle.alpha_glow_difference_constant
+    boxes = numpy.column_stack([particles[:, 0] - size / 2, particles[:, 1] - size / 2, size, size])
+    return numpy.floor(boxes).astype(int)
+
+
+def get_dirty_rects(boxes):
+    # marks the DIRTY_CELL_SIZE cells touched by the boxes and merges every row of marked cells into rects
+    # a box is never bigger than a cell, so marking the cells of its four corners covers it
+    cell = DIRTY_CELL_SIZE
+    cells = numpy.zeros((-(-screen_height // cell), -(-screen_width // cell)), dtype=bool)
+    x, y, w, h = boxes.T
+    on_screen = (x + w > 0) & (x < screen_width) & (y + h > 0) & (y < screen_height)
+    x, y, w, h = x[on_screen], y[on_screen], w[on_screen], h[on_screen]
+    x0, x1 = numpy.clip(x // cell, 0, cells.shape[1] - 1), numpy.clip((x + w - 1) // cell, 0, cells.shape[1] - 1)
+    y0, y1 = numpy.clip(y // cell, 0, cells.shape[0] - 1), numpy.clip((y + h - 1) // cell, 0, cells.shape[0] - 1)
+    cells[y0, x0] = cells[y0, x1] = cells[y1, x0] = cells[y1, x1] = True
+    screen_rect = screen.get_rect()
+    rects = []
+    for row, marked in enumerate(cells):
+        edges = numpy.flatnonzero(numpy.diff(numpy.concatenate([[0], marked.view(numpy.int8), [0]])))
+        for start, end in zip(edges[::2], edges[1::2]):
+            rects.append(pygame.Rect(start * cell, row * cell, (end - start) * cell, cell).clip(screen_rect))
+    return rects
+
+
+def particle_count():
+    if USE_NUMPY_ENGINE:
+        return flames.count
+    return sum(len(i.flame_particles) for i in flames)
+
+
+def remove_flames(qty):
+    if USE_NUMPY_ENGINE:
+        flames.remove_flames(qty)
+        return
+    del flames[len(flames) - qty:]
+
+
+def thin_flames(budget):
+    if USE_NUMPY_ENGINE:
+        flames.thin_flames(budget)
+
+
+class ParticleBudgetGovernor:
+    # scales the number of particles up or down to hold the target FPS
+    # the budget only changes after the frame time stayed outside the dead band for
+    # patience frames in a row, and not again for cooldown frames, so it does not oscillate
+    def __init__(self, target_fps=TARGET_FPS, budget=8000, min_budget=500, patience=30, cooldown=60):
+        self.frame_budget = 1000 / target_fps  # in ms
+        self.budget = budget
+        self.min_budget = min_budget
+        self.patience = patience
+        self.cooldown = cooldown
+        self.frame_time = self.frame_budget  # smoothed time of a whole frame
+        self.work_time = self.frame_budget  # smoothed time of a frame without the tick delay
+        self.slow_frames = 0
+        self.fast_frames = 0
+        self.frames_since_change = 0
+        self.decisions = []  # (frame, decision, frame_time, budget) for logging
+        self.frame = 0
+
+    def update(self, frame_time, work_time, particles):
+        self.frame += 1
+        self.frames_since_change += 1
+        self.frame_time += (frame_time - self.frame_time) * 0.1
+        self.work_time += (work_time - self.work_time) * 0.1
+        # slow: the frame rate is dropping below the target because the work does not fit in a frame,
+        # frames that are only late because clock.tick slept a bit too long do not count
+        # fast: there is a good amount of time left in every frame
+        if self.frame_time > self.frame_budget * 1.1 and self.work_time > self.frame_budget * 0.9:
+            self.slow_frames += 1
+            self.fast_frames = 0
+        elif self.work_time < self.frame_budget * 0.7:
+            self.fast_frames += 1
+            self.slow_frames = 0
+        else:
+            self.slow_frames = self.fast_frames = 0
+
+        if self.frames_since_change < self.cooldown:
+            return None
+        decision = None
+        budget = self.budget
+        if self.slow_frames >= self.patience:
+            budget = max(self.min_budget, int(min(self.budget, particles) * 0.85))
+            decision = 'decrease'
+        elif self.fast_frames >= self.patience and particles >= self.budget * 0.95:
+            # only grow when the budget is what is holding the particle count back
+            budget = int(self.budget * 1.15)
+            decision = 'increase'
+        if budget == self.budget:
+            return None
+        self.budget = budget
+        self.frames_since_change = self.slow_frames = self.fast_frames = 0
+        self.decisions.append((self.frame, decision, round(self.frame_time, 2), self.budget))
+        if LOG_GOVERNOR:
+            print(f'frame {self.frame}: {decision} budget to {self.budget} particles '
+                  f'(frame time = {self.frame_time:.2f} ms)')
+        return decision
+
+    @property
+    def last_decision(self):
+        return self.decisions[-1] if self.decisions else None
+
+
+# the budget starts high enough for the whole demo, the image and the ring need about 7000 particles
+governor = ParticleBudgetGovernor() if USE_GOVERNOR else None
+
+
+def flames_within_budget(qty, flame_intensity=1):
+    # number of the qty flames that can be added without going over the particle budget
+    if not governor:
+        return qty
+    return max(0, min(qty, (governor.budget - particle_count()) // flame_intensity))
+
+
+def flame_intensity_within_budget(qty, flame_intensity=1):
+    # particles per flame that let qty more flames fit in the particle budget, 0 if not even one particle each fits
+    if not governor:
+        return flame_intensity
+    return max(0, min(flame_intensity, (governor.budget - particle_count()) // qty))
+
 
 color_ranges = {
     'white': '>225,>225>225',
@@ -106,69 +428,162 @@ color_ranges = {
 }
 
 
-def check_color(color, condition: str):
-    r, g, b = condition.split(',')
-    r1, g1, b1 = color
+compare_operators = {
+    '>': operator.gt,
+    '<': operator.lt,
+    '==': operator.eq,
+}
 
-    def compare(x, y, compare_type):
-        x, y = int(x), int(y)
-        if compare_type == '>':
-            return x > y
-        elif compare_type == '<':
-            return x < y
-        elif compare_type == '==':
-            return x == y
 
-    red_compare_results = compare(r1, r[1:], r[0])
-    green_compare_results = compare(g1, g[1:], g[0])
-    blue_compare_results = compare(b1, b[1:], b[0])
+def compile_color_range(condition: str):
+    # turns a condition like '>100,<50,<50' into a list of (channel, operator, value)
+    compiled = []
+    for channel, rule in enumerate(condition.split(',')):
+        compare_type = '==' if rule.startswith('==') else rule[0]
+        compiled.append((channel, compare_operators[compare_type], int(rule[len(compare_type):])))
+    if len(compiled) != 3:
+        raise ValueError(f'color range {condition!r} must have one condition for each of r, g and b')
+    return compiled
 
-    if red_compare_results and green_compare_results and blue_compare_results:
-        return True
-    else:
-        return False
+
+def check_color(pixels: numpy.ndarray, compiled_condition):
+    # evaluates a compiled color range on a whole (w, h, 3) pixel array at once
+    result = numpy.ones(pixels.shape[:2], dtype=bool)
+    for channel, compare, value in compiled_condition:
+        result &= compare(pixels[..., channel], value)
+    return result
 
 
 def extract_points_from_img(image: pygame.Surface, image_color_range: dict, allowed_colors=('black', 'red')):
-    extracted_points = []
-    image.lock()
-    for x in range(image.get_width()):
-        for y in range(image.get_height()):
-            pixel_color = image.get_at([x, y])
-            r, g, b, alpha = pixel_color
-            if alpha > 127:
-                for color in list(image_color_range.keys()):
-                    if color in allowed_colors:
-                        if check_color((r, g, b), image_color_range[color]):
-                            extracted_points.append([x, y])
-    image.unlock()
-    return extracted_points
-
-
-img = pygame.image.load('durga1.png').convert()
-img = pygame.transform.scale(img, (int(img.get_width() * 720 / img.get_height()), 720))
-print('Loading Points...')
-points = extract_points_from_img(img, color_ranges)
-print('Points Loaded')
-
-
-def remove_point_cluttering(point_list):
-    # basic function to reduce the number of points
-    # only keeps points for every 4th point iterated
-    point_list.sort(key=lambda a: a[1])
-    point_list = [i for i in point_list if point_list.index(i) % 4 == 0]
+    pixels = pygame.surfarray.array3d(image).astype(int)
+    if image.get_flags() & pygame.SRCALPHA:
+        opaque = pygame.surfarray.array_alpha(image) > 127
+    else:
+        opaque = numpy.ones(pixels.shape[:2], dtype=bool)
+    # a pixel is added once for every allowed color range it matches
+    matches = numpy.zeros(pixels.shape[:2], dtype=int)
+    for color in image_color_range:
+        if color in allowed_colors:
+            matches += check_color(pixels, compile_color_range(image_color_range[color])) & opaque
+    # surfarray is indexed as [x][y], so the points come out in the same x then y order as before
+    xs, ys = numpy.nonzero(matches)
+    counts = matches[xs, ys]
+    return numpy.repeat(numpy.column_stack([xs, ys]), counts, axis=0).tolist()
+
+
+def poisson_disk_thinning(point_list: numpy.ndarray, spacing):
+    # greedy minimum distance thinning, a grid with cells smaller than spacing / sqrt(2)
+    # holds at most one kept point, so only the surrounding 5x5 cells have to be checked
+    cell_size = spacing / math.sqrt(2)
+    grid = {}
+    kept = []
+    spacing_sq = spacing * spacing
+    for i, (x, y) in enumerate(point_list.tolist()):
+        cx, cy = int(x // cell_size), int(y // cell_size)
+        for dx in range(-2, 3):
+            for dy in range(-2, 3):
+                other = grid.get((cx + dx, cy + dy))
+                if other and (other[0] - x) ** 2 + (other[1] - y) ** 2 < spacing_sq:
+                    break
+            else:
+                continue
+            break
+        else:
+            grid[cx, cy] = (x, y)
+            kept.append(i)
+    return point_list[kept]
+
+
+def remove_point_cluttering(point_list, mode='nth', spacing=4, target=3000):
+    # reduces the number of points in O(n log n) (the sort dominates)
+    if not point_list:
+        return []
+    point_list = numpy.asarray(point_list)
+    point_list = point_list[numpy.argsort(point_list[:, 1], kind='stable')]
+    if mode == 'nth':
+        point_list = point_list[::spacing]
+    elif mode == 'grid':
+        _, index = numpy.unique(point_list // spacing, axis=0, return_index=True)
+        point_list = point_list[numpy.sort(index)]
+    elif mode == 'poisson':
+        point_list = poisson_disk_thinning(point_list, spacing)
+    elif mode == 'target':
+        if target < len(point_list):
+            point_list = point_list[numpy.linspace(0, len(point_list) - 1, target).astype(int)]
+    else:
+        raise ValueError(f'unknown point decimation mode {mode!r}')
+    return point_list.tolist()
+
+
+def get_point_cache_key(image_path, image_height, image_color_range, allowed_colors):
+    # everything that changes the final points is part of the key
+    key = hashlib.sha256()
+    with open(image_path, 'rb') as f:
+        key.update(f.read())
+    settings = [image_height, screen_width, sorted(image_color_range.items()), sorted(allowed_colors),
+                POINT_DECIMATION_MODE, POINT_SPACING, TARGET_POINT_COUNT]
+    key.update(repr(settings).encode())
+    return key.hexdigest()
+
+
+def load_cached_points(cache_path, key):
+    try:
+        with numpy.load(cache_path) as data:
+            if str(data['key']) == key:
+                return data['points'].tolist()
+    except (OSError, KeyError, ValueError, EOFError, zipfile.BadZipFile):
+        # a missing, old or broken cache is extracted again
+        pass
+    return None
+
+
+def save_cached_points(cache_path, key, point_list):
+    # points fit in 16 bits, which keeps the cache file small
+    # the cache is written next to the old one and swapped in, so a save that is cut off leaves no broken file
+    temp_path = cache_path + '.tmp'
+    try:
+        with open(temp_path, 'wb') as f:
+            numpy.savez_compressed(f, key=numpy.array(key), points=numpy.array(point_list, dtype=numpy.int16))
+        os.replace(temp_path, cache_path)
+    except OSError:
+        # a read-only folder or a full disk only costs the cache, the extracted points are used anyway
+        print('Could not save the point cache')
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+
+
+def load_points(image: pygame.Surface, image_path, image_color_range: dict, allowed_colors=('black', 'red')):
+    if POINT_CACHE_FILE:
+        key = get_point_cache_key(image_path, image.get_height(), image_color_range, allowed_colors)
+        cached_points = load_cached_points(POINT_CACHE_FILE, key)
+        if cached_points is not None:
+            print('Points Loaded from cache')
+            return cached_points
+
+    print('Loading Points...')
+    point_list = extract_points_from_img(image, image_color_range, allowed_colors)
+    print('Points Loaded')
+
+    print('Removing Point Cluttering')
+    point_list = remove_point_cluttering(point_list, POINT_DECIMATION_MODE, POINT_SPACING, TARGET_POINT_COUNT)
+    print('Point Cluttering Reduced')
+
+    # shifting all points to center of screen
+    print('Shifting all points to center')
+    for p in point_list:
+        p[0] += screen_width // 2 - image.get_width() // 2
+    print('All points shifted to center')
+
+    if POINT_CACHE_FILE:
+        save_cached_points(POINT_CACHE_FILE, key, point_list)
     return point_list
 
 
-print('Removing Point Cluttering')
-points = remove_point_cluttering(point_list=points)
-print('Point Cluttering Reduced')
-
-# shifting all points to center of screen
-print('Shifting all points to center')
-for p in points:
-    p[0] += screen_width // 2 - img.get_width() // 2
-print('All points shifted to center')
+img = pygame.image.load(IMAGE_PATH).convert()
+img = pygame.transform.scale(img, (int(img.get_width() * IMAGE_HEIGHT / img.get_height()), IMAGE_HEIGHT))
+points = load_points(img, IMAGE_PATH, color_ranges, ALLOWED_COLORS)
 
 # circular points
 points2 = [[screen_width // 2 + 25 + screen_height // 2 * math.cos(math.radians(i)), screen_height // 2 + screen_height // 2 * math.sin(math.radians(i))] for i in range(360)]
@@ -177,8 +592,12 @@ points2 = [[screen_width // 2 + 25 + screen_height // 2 * math.cos(math.radians(
 def main_game():
     dt = 1
     surf = pygame.Surface(screen.get_size())  # to make the background fade away
-    surf.set_alpha(0)
     alpha = 0
+    # the image and the fade are composed once into the background and only rebuilt when alpha changes
+    background = pygame.Surface(screen.get_size())
+    background_alpha = None
+    dirty_rects = []
+    image_flames = None  # flames on the image once it is done, the ring flames come after them
     start = True  # set it to False if you want to manually trigger the animation after loading
     while True:
         for e in pygame.event.get():
@@ -189,30 +608,58 @@ def main_game():
                 start = True
                 if e.key == pygame.K_ESCAPE:
                     sys.exit(0)
-        screen.fill((0, 0, 0))
-        screen.blit(img, (screen_width // 2 - img.get_width() // 2, 0))
-        screen.blit(surf, (0, 0))  # the fading effect can also be done by changing the alpha of the image directly (can be used to improve FPS)
+        full_update = int(alpha) != background_alpha
+        if full_update:
+            background_alpha = int(alpha)
+            background.fill((0, 0, 0))
+            background.blit(img, (screen_width // 2 - img.get_width() // 2, 0))
+            surf.set_alpha(background_alpha)
+            background.blit(surf, (0, 0))
+            screen.blit(background, (0, 0))
+        else:
+            # erase the flames of the last frame
+            screen.blits([(background, rect, rect) for rect in dirty_rects], doreturn=False)
         if start:
-            if len(flames) < len(points):
+            if image_flames is None:
                 qty = 5 if len(points) - len(flames) > 5 else len(points) - len(flames)
-                for _ in range(qty):
-                    flames.append(Flame(*points[len(flames)]))
+                fitting = flames_within_budget(qty)
+                add_flames(points[len(flames):len(flames) + fitting])
+                if len(flames) == len(points) or fitting < qty:
+                    # the whole image is on fire, or as much of it as the particle budget allows
+                    image_flames = len(flames)
             else:
                 alpha += 0.5
                 if alpha > 255:
                     alpha = 255
-                surf.set_alpha(int(alpha))
         if alpha >= 255:
-            if len(flames) < len(points) + len(points2):
-                temp = Flame(*points2[len(flames) - len(points)])
-                temp.flame_intensity = 10
-                temp.generate_flame_particles()
-                flames.append(temp)
-        for i in flames:
-            i.draw_flame(dt)
-        pygame.display.update()
-        pygame.display.set_caption('Flame Particles Testing FPS = ' + str(int(clock.get_fps())))
-        dt = TARGET_FPS * clock.tick(FPS) * 0.001
+            # the governor may have put out flames of the image too
+            image_flames = min(image_flames, len(flames))
+            ring_flames = len(flames) - image_flames
+            if ring_flames < len(points2):
+                # the ring flames get smaller when the budget can not hold all of them at full size
+                intensity = flame_intensity_within_budget(len(points2) - ring_flames, 10)
+                if intensity:
+                    add_flames(points2[ring_flames:ring_flames + 1], flame_intensity=intensity)
+        new_dirty_rects = get_dirty_rects(draw_flames(dt))
+        # with pygame.SCALED the renderer presents the whole frame even when only rects are updated,
+        # so there only the precomposed background saves time, presenting the rects helps without SCALED
+        if full_update:
+            pygame.display.update()
+        else:
+            pygame.display.update(dirty_rects + new_dirty_rects)
+        dirty_rects = new_dirty_rects
+        caption = 'Flame Particles Testing FPS = ' + str(int(clock.get_fps()))
+        frame_time = clock.tick(FPS)
+        dt = TARGET_FPS * frame_time * 0.001
+        if governor:
+            governor.update(frame_time, clock.get_rawtime(), particle_count())
+            # when the budget goes down the biggest flames get smaller first,
+            # then the newest flames are put out
+            thin_flames(governor.budget)
+            while len(flames) and particle_count() > governor.budget:
+                remove_flames(1)
+            caption += f' particles = {particle_count()} budget = {governor.budget}'
+        pygame.display.set_caption(caption)
 
 
 main_game()
@@ -2,12 +2,13 @@ import asyncio
 import math
 import os.path
 import platform
-import random
 import sys
 import time
 from functools import lru_cache
+from itertools import repeat
 from operator import attrgetter
 
+import numpy
 import pygame
 import pygame.mixer
 from pygame.math import clamp
@@ -23,6 +24,18 @@ SCREEN_COLLISION_RECT = SCREEN_RECT.inflate(500, 200)
 
 GRAVITY = +0.01
 
+RAIN_RATE = 60  # drops per second
+RAIN_CAPACITY = 4096  # most drops at once, no more are added while the pool is full
+
+# the glass is blurred on a smaller copy of what is behind it, the quality is how much smaller (Q cycles it)
+BLUR_QUALITIES = {'low': 8, 'medium': 4, 'high': 2, 'full': 1}
+BLUR_QUALITY = 'medium'
+BLUR_RADIUS = 100
+# the last blur is kept while what is behind the glass differs less than this from when it was made (0-255 per pixel)
+# the two are compared at 1 / BLUR_REUSE_SCALE of the size
+BLUR_REUSE_DIFF = 1.0
+BLUR_REUSE_SCALE = 8
+
 pygame.init()
 
 CAR_WINDOW_SOUND = pygame.mixer.Sound(os.path.join('assets', 'sounds', 'car-window.ogg'))
@@ -188,51 +201,69 @@ class ParallaxScrollingImage(BaseObject):
             i.draw(surf)
 
 
-class RainParticle(BaseObject):
-    def __init__(self, x, y, angle):
-        self.x, self.y = x, y
-        self.angle = angle
-        self.speed = 10
-        self.dx = math.cos(math.radians(self.angle))
-        self.dy = -math.sin(math.radians(self.angle))
-        self.destroyed = False
-
-    @property
-    def pos(self):
-        return [self.x, self.y]
-
-    def update(self, events: list[pygame.event.Event], dt):
-        self.x += self.dx * self.speed * dt
-        self.y += self.dy * self.speed * dt
-        if not SCREEN_COLLISION_RECT.collidepoint(self.pos):
-            self.destroyed = True
-
-
 class Rain(BaseObject):
-    def __init__(self):
+    # all the drops live in fixed arrays, the ones in use are always the first self.count
+    def __init__(self, rate=RAIN_RATE, capacity=RAIN_CAPACITY):
         self.img = load_image('rain_drop.png', 1)
         self.img.set_colorkey('black')
         self.angle = 180 + 45
-        self.particles: list[RainParticle] = []
-        self.timer = Timer(1 / 60)
+        self.speed = 10
+        self.dx = math.cos(math.radians(self.angle))
+        self.dy = -math.sin(math.radians(self.angle))
+        self.rate = rate
+        self.emit = 0.0  # drops that are due but not added yet
+        self.count = 0
+        self.x = numpy.zeros(capacity)
+        self.y = numpy.zeros(capacity)
+
+    def spawn(self, qty):
+        qty = min(qty, len(self.x) - self.count)
+        new = slice(self.count, self.count + qty)
+        self.x[new] = numpy.random.randint(0, int(W * 1.5) + 1, qty)
+        self.y[new] = -40
+        self.count += qty
 
     def update(self, events: list[pygame.event.Event], dt):
-        if self.timer.tick:
-            self.particles.append(RainParticle(random.randint(0, int(W * 1.5)), -40, self.angle))
-        self.particles = [i for i in self.particles if not i.destroyed]
-        for i in self.particles:
-            i.update(events, dt)
+        # dt counts frames at 60 FPS
+        self.emit += self.rate * dt / (60 * RES)
+        if self.emit >= 1:
+            self.spawn(int(self.emit))
+            self.emit %= 1
+        x, y = self.x[:self.count], self.y[:self.count]
+        x += self.dx * self.speed * dt
+        y += self.dy * self.speed * dt
+        r = SCREEN_COLLISION_RECT
+        alive = (x >= r.left) & (x < r.right) & (y >= r.top) & (y < r.bottom)
+        if not alive.all():
+            self.count = int(alive.sum())
+            self.x[:self.count] = x[alive]
+            self.y[:self.count] = y[alive]
 
     def draw(self, surf: pygame.Surface):
-        surf.fblits([(self.img, self.img.get_rect(center=i.pos)) for i in self.particles])
+        w, h = self.img.get_size()
+        n = self.count
+        pos = numpy.empty((n, 2), dtype=int)
+        pos[:, 0] = self.x[:n]
+        pos[:, 1] = self.y[:n]
+        pos -= [w // 2, h // 2]
+        surf.fblits(zip(repeat(self.img, n), pos.tolist()))
 
 
 class Window(BaseObject):
     def __init__(self):
         self.rect = pygame.FRect(0, 0, W, H)
-        self.s = pygame.Surface([*self.rect.size])
-        self.s1 = self.s.copy()
-        self.s2 = self.s.copy()
+        # the glass draws into views of these full size buffers, so moving it allocates nothing
+        self.buffers = {
+            's': pygame.Surface([W, H]),
+            's1': pygame.Surface([W, H]),
+            'probe': pygame.Surface([max(1, W // BLUR_REUSE_SCALE), max(1, H // BLUR_REUSE_SCALE)]),
+            'thumb': pygame.Surface([max(1, W // 2), max(1, H // 2)]),  # big enough for every quality below full
+            'thumb_blur': pygame.Surface([max(1, W // 2), max(1, H // 2)]),
+        }
+        self.views = {}
+        self.s = self.view('s', [W, H])
+        self.s1 = self.view('s1', [W, H])
+        self.s2 = pygame.Surface([W, H])
         self.timer = Timer(1 / 24)  # 24 FPS is the original FPS of recording of video
         self.curr_frame = 0
 
@@ -249,13 +280,26 @@ class Window(BaseObject):
         self.images = [load_image(os.path.join('rain', f'frame_{i}.png'), RES * 0.3, alpha=False) for i in
                        generate_strings()[1:]]
         self.defog_timer = Timer(0.1)
+        self.defog_rect = None  # the part of s2 that is not black
+        self.defog_steps = 0  # fading steps until s2 is black again
+        self.quality = BLUR_QUALITY
+        self.blur_thumb = None  # what was behind the glass when self.s was blurred
+
+    def view(self, name, size):
+        # the top left part of a buffer, kept for every size that was asked for
+        key = (name, *size)
+        if key not in self.views:
+            self.views[key] = self.buffers[name].subsurface([0, 0, *size])
+        return self.views[key]
 
     def pull_up(self, amt=1):
         self.rect = pygame.FRect(self.rect.x, self.rect.y - amt, self.rect.w, self.rect.h + amt)
         self.rect.y = pygame.math.clamp(self.rect.y, 0, H - 1)
         self.rect.h = pygame.math.clamp(self.rect.h, 1, H)
-        self.s = pygame.Surface([*self.rect.size])
-        self.s1 = self.s.copy()
+        size = pygame.Rect(self.rect).size
+        self.s = self.view('s', size)
+        self.s1 = self.view('s1', size)
+        self.blur_thumb = None
         if not CHANNELS.CAR_WINDOW.get_busy():
             CHANNELS.CAR_WINDOW.play(CAR_WINDOW_SOUND, -1)
         if self.rect.y == 0 or self.rect.y == H:
@@ -265,6 +309,11 @@ class Window(BaseObject):
         self.pull_up(-amt)
 
     def update(self, events: list[pygame.event.Event], dt):
+        for e in events:
+            if e.type == pygame.KEYDOWN and e.key == pygame.K_q:
+                qualities = list(BLUR_QUALITIES)
+                self.quality = qualities[(qualities.index(self.quality) + 1) % len(qualities)]
+                self.blur_thumb = None
         if self.timer.tick:
             self.curr_frame += 1
             self.curr_frame %= len(self.images)
@@ -284,26 +333,55 @@ class Window(BaseObject):
         CHANNELS.RAIN.set_volume(map_to_range(self.rect.y, 0, H / 4, 0.02, 1))
         CHANNELS.ENGINE.set_volume(map_to_range(self.rect.y, 0, H / 4, 0.1, 1))
 
+    def blur(self, behind: pygame.Surface):
+        # blurs what is behind the glass into self.s, unless it barely changed since the last blur
+        w, h = behind.get_size()
+        probe = self.view('probe', [max(1, w // BLUR_REUSE_SCALE), max(1, h // BLUR_REUSE_SCALE)])
+        pygame.transform.smoothscale(behind, probe.get_size(), probe)
+        pixels = pygame.surfarray.array3d(probe).astype(numpy.int16)
+        if self.blur_thumb is not None and self.blur_thumb.shape == pixels.shape:
+            if numpy.abs(pixels - self.blur_thumb).mean() < BLUR_REUSE_DIFF:
+                return
+        self.blur_thumb = pixels
+        factor = BLUR_QUALITIES[self.quality]
+        if factor == 1:
+            pygame.transform.box_blur(behind, BLUR_RADIUS, dest_surface=self.s)
+        else:
+            size = [max(1, w // factor), max(1, h // factor)]
+            thumb = self.view('thumb', size)
+            thumb_blur = self.view('thumb_blur', size)
+            pygame.transform.smoothscale(behind, size, thumb)
+            pygame.transform.box_blur(thumb, max(1, BLUR_RADIUS // factor), dest_surface=thumb_blur)
+            pygame.transform.smoothscale(thumb_blur, [w, h], self.s)
+
     def draw(self, surf: pygame.Surface):
-        s = surf.subsurface(self.rect).copy()
-        pygame.transform.box_blur(s, 100, dest_surface=self.s)
-        # self.s.fill([220] * 3, special_flags=pygame.BLEND_RGB_MULT)
-        self.s1.blit(s, [0, 0])
-        # self.s1.fill([155] * 3, special_flags=pygame.BLEND_RGB_MULT)
-        # pygame.draw.rect(self.s1, 'black', [0, 0, 200, H])
+        rect = pygame.Rect(self.rect)
+        behind = surf.subsurface(rect)
+        self.blur(behind)
         if self.rect.y > 10:
             self.defog_timer.timeout = 1
         else:
             self.defog_timer.timeout = 0.1
-        if self.defog_timer.tick:
+        if self.defog_timer.tick and self.defog_steps:
             self.s2.fill([1] * 3, special_flags=pygame.BLEND_RGB_SUB)
+            self.defog_steps -= 1
+            if not self.defog_steps:
+                self.defog_rect = None
         if pygame.mouse.get_pressed()[0]:
             mx, my = pygame.mouse.get_pos()
-            pygame.draw.circle(self.s2, 'white', [mx, my - self.rect.y], 40)
-        self.s1.blit(self.s2, [0, 0], special_flags=pygame.BLEND_RGB_MULT)
-        self.s.blit(self.s1, [0, 0], special_flags=pygame.BLEND_RGB_MAX)
-        self.s.blit(self.images[self.curr_frame], [0, 0], special_flags=pygame.BLEND_RGB_ADD)
-        surf.blit(self.s, self.rect)
+            wiped = pygame.draw.circle(self.s2, 'white', [mx, my - self.rect.y], 40)
+            self.defog_rect = wiped.union(self.defog_rect) if self.defog_rect else wiped
+            self.defog_steps = 255
+        # the glass is the blur, or what is behind it where it was wiped and has not fogged up again
+        # all of that is only done where s2 is not black, everywhere else the blur is drawn as it is
+        wiped = self.defog_rect.clip(self.s1.get_rect()) if self.defog_rect else None
+        if wiped:
+            self.s1.blit(behind, wiped, wiped)
+            self.s1.blit(self.s2, wiped, wiped, special_flags=pygame.BLEND_RGB_MULT)
+        surf.blit(self.s, rect)
+        if wiped:
+            surf.blit(self.s1, wiped.move(rect.topleft), wiped, special_flags=pygame.BLEND_RGB_MAX)
+        surf.blit(self.images[self.curr_frame], rect, [0, 0, *rect.size], special_flags=pygame.BLEND_RGB_ADD)
         pygame.draw.line(surf, 'gray', [self.rect.x, self.rect.y - 1], [self.rect.x + self.rect.w, self.rect.y - 1],
                          math.ceil(RES))
 
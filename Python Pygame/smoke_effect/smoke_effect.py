@@ -1,5 +1,6 @@
 import pygame
 import random
+import os
 
 screen_width = 750
 screen_height = 650
@@ -17,13 +18,76 @@ def scale(img: pygame.Surface, factor):
 
 IMAGE = pygame.image.load('smoke.png').convert_alpha()
 
+# the smoke image is pre-scaled in steps of ATLAS_SCALE_STEP and particles use the nearest one
+# so a particle is never more than ATLAS_SCALE_STEP / 2 * image size pixels off its real size
+ATLAS_SCALE_STEP = 0.01
+ATLAS_MIN_SCALE = 0.1
+ATLAS_MAX_SCALE = 1.0
+ATLAS_FILE = None  # set it to a file name like 'smoke_atlas.png' to save the atlas and load it on later runs
+
+
+class SpriteAtlas:
+    def __init__(self, img: pygame.Surface, min_scale, max_scale, step, file=None):
+        self.min_scale = min_scale
+        self.step = step
+        count = int(round((max_scale - min_scale) / step)) + 1
+        scales = [min_scale + i * step for i in range(count)]
+        sizes = [(int(img.get_width() * k), int(img.get_height() * k)) for k in scales]
+        sheet = None
+        if file and os.path.exists(file):
+            sheet = pygame.image.load(file).convert_alpha()
+            if sheet.get_size() != (sum(w for w, h in sizes), max(h for w, h in sizes)):
+                sheet = None  # saved with other settings
+        if sheet is None:
+            self.images = [scale(img, k) for k in scales]
+            if file:
+                self.save(file)
+        else:
+            # all the sizes are stored side by side in one image
+            self.images = []
+            x = 0
+            for w, h in sizes:
+                self.images.append(sheet.subsurface((x, 0, w, h)).copy())
+                x += w
+
+    def save(self, file):
+        sheet = pygame.Surface((sum(i.get_width() for i in self.images),
+                                max(i.get_height() for i in self.images)), pygame.SRCALPHA)
+        x = 0
+        for i in self.images:
+            sheet.blit(i, (x, 0))
+            x += i.get_width()
+        pygame.image.save(sheet, file)
+
+    def get(self, scale_k):
+        index = round((scale_k - self.min_scale) / self.step)
+        return self.images[min(max(index, 0), len(self.images) - 1)]
+
+
+ATLAS = SpriteAtlas(IMAGE, ATLAS_MIN_SCALE, ATLAS_MAX_SCALE, ATLAS_SCALE_STEP, ATLAS_FILE)
+atlases = {1: ATLAS}
+
+
+def get_atlas(factor):
+    # the atlas used to draw into a buffer that is factor times smaller than the screen
+    if factor not in atlases:
+        atlases[factor] = SpriteAtlas(IMAGE, ATLAS_MIN_SCALE / factor, ATLAS_MAX_SCALE / factor,
+                                      ATLAS_SCALE_STEP / factor)
+    return atlases[factor]
+
+
+# smoke is soft, so it can be drawn at a lower resolution and scaled up once per frame
+# 1 = full resolution, 2 = half, 4 = quarter (press R to cycle)
+SMOKE_RESOLUTION = 1
+SMOKE_RESOLUTIONS = [1, 2, 4]
+SMOOTH_UPSCALE = True  # smoothscale instead of scale when scaling the smoke up (press F to toggle)
+
 
 class SmokeParticle:
     def __init__(self, x=screen_width // 2, y=screen_height // 2):
         self.x = x
         self.y = y
         self.scale_k = 0.1
-        self.img = scale(IMAGE, self.scale_k)
         self.alpha = 255
         self.alpha_rate = 3
         self.alive = True
@@ -44,11 +108,12 @@ class SmokeParticle:
         self.alpha_rate -= 0.1
         if self.alpha_rate < 1.5:
             self.alpha_rate = 1.5
-        self.img = scale(IMAGE, self.scale_k)
-        self.img.set_alpha(self.alpha)
 
-    def draw(self):
-        screen.blit(self.img, self.img.get_rect(center=(self.x, self.y)))
+    def draw(self, surf: pygame.Surface, factor=1):
+        img = get_atlas(factor).get(self.scale_k / factor)
+        # the atlas images are shared, so the alpha is set right before drawing
+        img.set_alpha(self.alpha)
+        return surf.blit(img, img.get_rect(center=(self.x / factor, self.y / factor)))
 
 
 class Smoke:
@@ -67,15 +132,48 @@ class Smoke:
         for i in self.particles:
             i.update()
 
-    def draw(self):
-        for i in self.particles:
-            i.draw()
+    def draw(self, surf: pygame.Surface, factor=1):
+        # returns the rects that were drawn to
+        return [i.draw(surf, factor) for i in self.particles]
+
+
+class SmokeLayer:
+    # draws the smoke into an offscreen buffer at 1 / SMOKE_RESOLUTION of the screen resolution
+    # and scales it up once per frame, all the smoke emitters share the same buffer
+    # only the part of the buffer that has smoke on it is cleared and scaled up
+    def __init__(self):
+        self.buffer = None
+        self.rect = None  # the part of the buffer that was drawn to in the last frame
+
+    def draw(self, surf: pygame.Surface, smokes):
+        if SMOKE_RESOLUTION == 1:
+            for i in smokes:
+                i.draw(surf)
+            return
+        w, h = surf.get_size()
+        size = (w // SMOKE_RESOLUTION, h // SMOKE_RESOLUTION)
+        if not self.buffer or self.buffer.get_size() != size:
+            self.buffer = pygame.Surface(size)
+            self.rect = None
+        if self.rect:
+            self.buffer.fill(0, self.rect)
+        rects = [r for i in smokes for r in i.draw(self.buffer, SMOKE_RESOLUTION) if r]
+        self.rect = rects[0].unionall(rects) if rects else None
+        if not self.rect:
+            return
+        k = SMOKE_RESOLUTION
+        dest = pygame.Rect(self.rect.x * k, self.rect.y * k, self.rect.w * k, self.rect.h * k)
+        upscale = pygame.transform.smoothscale if SMOOTH_UPSCALE else pygame.transform.scale
+        # the screen is black under the smoke, so the smoke is scaled straight onto it
+        upscale(self.buffer.subsurface(self.rect), dest.size, surf.subsurface(dest))
 
 
 smoke = Smoke()
+smoke_layer = SmokeLayer()
 
 
 def main_game():
+    global SMOKE_RESOLUTION, SMOOTH_UPSCALE
     while True:
         events = pygame.event.get()
         for e in events:
@@ -84,12 +182,18 @@ def main_game():
             if e.type == pygame.KEYDOWN:
                 if e.key == pygame.K_ESCAPE:
                     quit()
+                if e.key == pygame.K_r:
+                    index = SMOKE_RESOLUTIONS.index(SMOKE_RESOLUTION)
+                    SMOKE_RESOLUTION = SMOKE_RESOLUTIONS[(index + 1) % len(SMOKE_RESOLUTIONS)]
+                if e.key == pygame.K_f:
+                    SMOOTH_UPSCALE = not SMOOTH_UPSCALE
         screen.fill((0, 0, 0))
         smoke.update()
-        smoke.draw()
+        smoke_layer.draw(screen, [smoke])
         pygame.display.update()
         clock.tick(FPS)
-        pygame.display.set_caption(f'FPS = {clock.get_fps()}')
+        pygame.display.set_caption(f'FPS = {clock.get_fps()} resolution = 1/{SMOKE_RESOLUTION} '
+                                   f'filter = {"smooth" if SMOOTH_UPSCALE else "nearest"}')
 
 
 main_game()
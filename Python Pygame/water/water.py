@@ -1,29 +1,85 @@
 import math
+import os
 import sys
+import time
+import zipfile
+from collections import OrderedDict
 from random import randint, random
-from typing import Union
 
-import pygame
+STARTUP_TIME = time.perf_counter()  # the startup report counts from here
 
-Point = pygame.Vector2
+import numpy
+import pygame
 
 # INITIAL RUNTIME CONFIGURATIONS
 
 # You can edit these accordingly based on the modules you have
 
-SMOOTH = True  # uses numpy + scipy
+SMOOTH = True  # uses scipy
+# the spline basis of the smooth curve is saved here, so scipy is only needed the first time
+SPLINE_CACHE_FILE = 'water.spline.npz'  # None turns the cache off
 TEXTURE = True  # uses texture images
 VOLUME_RISE = True
 USE_PYMUNK = True  # uses pymunk
+# for thousands of rocks: spatial hash broadphase and sleeping in pymunk, rocks that come to rest
+# are turned into static rubble that is drawn once and rocks that leave the screen are removed
+MANY_ROCKS = False
+REST_SPEED = 20  # rocks slower than this (in px/s) for REST_TIME seconds are resting
+REST_TIME = 0.5
 FPS = 60
+# the simulation runs in fixed steps no matter how fast the frames are drawn
+SIM_DT = 1 / 60  # the springs are tuned for 60 steps per second
+PHYSICS_SUBSTEPS = 2  # pymunk steps for every simulation step
+MAX_SIM_STEPS = 5  # most steps to catch up in one frame, the rest is dropped if drawing stalls
+FAST_FORWARD_SECONDS = 5  # simulated without drawing when F is pressed
 GRAVITY = (0, 500)
 DISPLAY_HELP = True
-
-if SMOOTH:
-    import numpy
-    from scipy.interpolate import interp1d
-if USE_PYMUNK:
-    import pymunk
+# flat parts of the water surface are drawn with fewer vertices
+# a vertex is kept where the curve bends more than LOD_TOLERANCE px per px^2
+# and at least every LOD_MAX_GAP vertices, this keeps the error below LOD_TOLERANCE * LOD_MAX_GAP^2 / 8 px
+LOD_TOLERANCE = 0.005
+LOD_MAX_GAP = 32
+# rotated and scaled sprites are cached, angles are rounded to ANGLE_STEP degrees
+ANGLE_STEP = 2
+TRANSFORM_CACHE_SIZE = 64 * 1024 * 1024  # in bytes, the least recently used sprites are removed above this
+# top-down view of the water as a grid of heights, drops make ripples that run into each other
+RIPPLE_TANK = False
+RIPPLE_SIZE = (512, 512)  # grid cells, the grid is scaled to the height of the screen
+RIPPLE_SPEED = 0.25  # the square of the wave speed in cells per step, stays stable up to 0.5
+RIPPLE_DAMPENING = 0.01
+RIPPLE_SHADING = 6  # how bright the slopes facing the light get
+# prints how long every part of the startup took until the first frame,
+# scipy, pymunk, the images and the font are only loaded when they are first used
+STARTUP_REPORT = True
+
+startup_phases = []  # (phase, seconds) until the first frame
+startup_done = False
+
+
+def startup_phase(phase, start):
+    # records a phase that began at start and returns when it ended, so the next phase can start there
+    end = time.perf_counter()
+    if not startup_done:
+        startup_phases.append((phase, end - start))
+    elif STARTUP_REPORT:
+        # loaded later, when its toggle was switched on
+        print(f'{phase}: {(end - start) * 1000:.0f} ms')
+    return end
+
+
+def print_startup_report():
+    global startup_done
+    startup_done = True
+    if not STARTUP_REPORT:
+        return
+    total = time.perf_counter() - STARTUP_TIME
+    rest = total - sum(seconds for _, seconds in startup_phases)
+    for phase, seconds in startup_phases + [('everything else', rest)]:
+        print(f'{phase:<30}{seconds * 1000:>6.0f} ms')
+    print(f'{"time to first frame":<30}{total * 1000:>6.0f} ms')
+
+
+phase_start = startup_phase('numpy and pygame imports', STARTUP_TIME)
 
 pygame.init()
 
@@ -34,17 +90,92 @@ screen = pygame.display.set_mode((screen_width, screen_height))
 pygame.display.set_caption('Water')
 
 clock = pygame.time.Clock()
+startup_phase('pygame init and window', phase_start)
+
+pymunk = None
+space = None
+font = None
+images = {}
+
+
+def load_pymunk():
+    global pymunk
+    if pymunk is None:
+        start = time.perf_counter()
+        import pymunk
+        startup_phase('pymunk import', start)
+
+
+def enable_pymunk(wave: 'Wave'):
+    # the space is created the first time pymunk is switched on
+    global space
+    if space is None:
+        load_pymunk()
+        space = create_space()
+        create_walls(space)
+        create_water_sensor(wave)
+
+
+def get_font():
+    global font
+    if font is None:
+        start = time.perf_counter()
+        font = pygame.font.SysFont('consolas', 25)
+        startup_phase('font', start)
+    return font
+
+
+def get_image(file):
+    if file not in images:
+        start = time.perf_counter()
+        images[file] = pygame.image.load(file).convert_alpha()
+        startup_phase(f'{file} loading', start)
+    return images[file]
+
+
+def create_space():
+    _space = pymunk.Space()
+    _space.gravity = GRAVITY
+    if MANY_ROCKS:
+        # the cell size is about the size of an average rock
+        _space.use_spatial_hash(60, 10000)
+        _space.sleep_time_threshold = REST_TIME
+        _space.idle_speed_threshold = REST_SPEED
+    return _space
+
+
+# collision types of the pymunk shapes
+ROCK_COLLISION_TYPE = 1
+WATER_COLLISION_TYPE = 2
+water_sensor = None
+
+
+class TransformCache:
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.sprites = OrderedDict()
+
+    def get(self, img: pygame.Surface, size, angle=0):
+        size = (int(size[0]), int(size[1]))
+        angle = round(angle / ANGLE_STEP) * ANGLE_STEP % 360
+        key = (img, size, angle)
+        if key in self.sprites:
+            self.sprites.move_to_end(key)
+            return self.sprites[key]
+        if angle:
+            sprite = pygame.transform.rotate(self.get(img, size), angle)
+        else:
+            sprite = pygame.transform.scale(img, size)
+        self.sprites[key] = sprite
+        self.size += sprite.get_width() * sprite.get_height() * sprite.get_bytesize()
+        while self.size > self.max_size and len(self.sprites) > 1:
+            _, old_sprite = self.sprites.popitem(last=False)
+            self.size -= old_sprite.get_width() * old_sprite.get_height() * old_sprite.get_bytesize()
+        return sprite
 
 
-font = pygame.font.SysFont('consolas', 25)
-
-if USE_PYMUNK:
-    space = pymunk.Space()
-    space.gravity = GRAVITY
-
-if TEXTURE:
-    ROCK_IMAGE = pygame.image.load('rock.png').convert_alpha()
-    BALL_IMAGE = pygame.image.load('ball.png').convert_alpha()
+transform_cache = TransformCache(TRANSFORM_CACHE_SIZE)
 
 
 def map_to_range(value, from_x, from_y, to_x, to_y):
@@ -60,25 +191,139 @@ def create_rock(_space, x=None, y=None):
     body = pymunk.Body(mass=mass * 5, moment=mass * 1, body_type=pymunk.Body.DYNAMIC)
     body.position = (x + random(), y)
     body.splashed = False
+    body.resting_steps = 0
+    # state before the last simulation step, the rock is drawn in between
+    body.prev_position = body.position
+    body.prev_angle = body.angle
     shape = pymunk.Circle(body, body.mass * 1)
-    if TEXTURE:
-        shape.img = ROCK_IMAGE
-        shape.img = pygame.transform.scale(shape.img, (shape.radius * 2, shape.radius * 2))
     shape.friction = 0.05
+    shape.collision_type = ROCK_COLLISION_TYPE
     _space.add(body, shape)
     return shape
 
 
-def draw_rock(rock, surf: pygame.Surface):
+def splash_rock(rock, wave: 'Wave'):
+    if rock.body.splashed:
+        return
+    rock.body.splashed = True
+    wave.splash(index=wave.get_spring_index_for_x_pos(rock.body.position.x), vel=rock.radius)
+    if VOLUME_RISE:
+        wave.add_volume(rock.radius ** 2 * math.pi)
+        # bodies can not be moved while the space is stepping
+        space.add_post_step_callback(move_water_sensor, 'move_water_sensor', wave)
+
+
+def create_water_sensor(wave: 'Wave'):
+    # a sensor line along the water, pymunk reports when a rock starts touching it
+    # so the splashes do not need a check for every rock in every frame
+    global water_sensor
+    water_sensor = pymunk.Body(body_type=pymunk.Body.STATIC)
+    water_sensor.position = (0, wave.get_target_height())
+    shape = pymunk.Segment(water_sensor, (-100, 0), (screen_width + 100, 0), 1)
+    shape.sensor = True
+    shape.collision_type = WATER_COLLISION_TYPE
+    space.add(water_sensor, shape)
+    space.on_collision(ROCK_COLLISION_TYPE, WATER_COLLISION_TYPE, begin=on_rock_enters_water, data=wave)
+
+
+def move_water_sensor(_space, _key, wave: 'Wave'):
+    water_sensor.position = (0, wave.get_target_height())
+    _space.reindex_shapes_for_body(water_sensor)
+
+
+def on_rock_enters_water(arbiter, _space, wave: 'Wave'):
+    rock, _ = arbiter.shapes
+    splash_rock(rock, wave)
+
+
+def get_rock_blit(rock, alpha=1.0):
+    # alpha is how far the frame is between the last two simulation steps
+    body = rock.body
+    position = body.prev_position.interpolate_to(body.position, alpha)
+    try:
+        angle = round(math.degrees(body.prev_angle + (body.angle - body.prev_angle) * alpha))
+    except ValueError:
+        angle = 0
+    img = transform_cache.get(get_image('rock.png'), (rock.radius * 2, rock.radius * 2), -angle)
+    return img, img.get_rect(center=position)
+
+
+def draw_rock(rock, surf: pygame.Surface, alpha=1.0):
     if TEXTURE:
-        try:
-            angle = round(math.degrees(rock.body.angle))
-        except ValueError:
-            angle = 0
-        img = pygame.transform.rotate(rock.img, -angle)
-        surf.blit(img, img.get_rect(center=rock.body.position))
+        surf.blit(*get_rock_blit(rock, alpha))
     else:
-        pygame.draw.circle(surf, 'brown', rock.body.position, rock.radius)
+        position = rock.body.prev_position.interpolate_to(rock.body.position, alpha)
+        pygame.draw.circle(surf, 'brown', position, rock.radius)
+
+
+def draw_rocks(rocks, surf: pygame.Surface, alpha=1.0):
+    if TEXTURE:
+        # one batched submission for all the rocks
+        surf.fblits([get_rock_blit(i, alpha) for i in rocks])
+    else:
+        for i in rocks:
+            draw_rock(i, surf, alpha)
+
+
+class Rubble:
+    # rocks that came to rest are replaced by static circles and drawn once onto this layer
+    def __init__(self):
+        self.surf = pygame.Surface(screen.get_size(), pygame.SRCALPHA)
+        self.rect = None  # the part of the layer that has rocks on it
+        self.rocks = []
+
+    def add(self, rock, _space):
+        body = rock.body
+        # changing the type of a sleeping body can break the sleeping groups of pymunk,
+        # so the rock is removed and a static shape takes its place
+        _space.remove(body, rock)
+        static_rock = pymunk.Circle(_space.static_body, rock.radius, body.position)
+        static_rock.friction = rock.friction
+        _space.add(static_rock)
+        # a shape only keeps a weak reference to its body, so the removed body is gone after this
+        # and only what is needed to draw the rock again is kept
+        self.rocks.append((rock.radius, tuple(body.position), body.angle))
+        self.draw_rock(*self.rocks[-1])
+
+    def draw_rock(self, radius, position, angle):
+        if TEXTURE:
+            img = transform_cache.get(get_image('rock.png'), (radius * 2, radius * 2), -round(math.degrees(angle)))
+            self.surf.blit(img, img.get_rect(center=position))
+        else:
+            pygame.draw.circle(self.surf, 'brown', position, radius)
+        rect = pygame.Rect(0, 0, radius * 2 + 2, radius * 2 + 2)
+        rect.center = position
+        self.rect = rect.union(self.rect) if self.rect else rect
+
+    def redraw(self):
+        # needed when the texture is toggled
+        self.surf.fill(0)
+        self.rect = None
+        for i in self.rocks:
+            self.draw_rock(*i)
+
+    def draw(self, surf: pygame.Surface):
+        if self.rect:
+            surf.blit(self.surf, self.rect, self.rect)
+
+
+def retire_rocks(objects, _space, rubble: Rubble):
+    # called after every simulation step, only the rocks that are still moving are kept in objects
+    # pymunk only puts a whole pile to sleep at once, so rocks that rest on their own are retired too,
+    # every retired rock splits the pile into smaller groups that fall asleep sooner
+    active = []
+    for i in objects:
+        body = i.body
+        x, y = body.position
+        if y - i.radius > screen_height or x + i.radius < 0 or x - i.radius > screen_width:
+            _space.remove(body, i)
+            continue
+        body.resting_steps = body.resting_steps + 1 if body.velocity.length < REST_SPEED else 0
+        if body.is_sleeping or body.resting_steps > REST_TIME / SIM_DT:
+            rubble.add(i, _space)
+        else:
+            active.append(i)
+    objects[:] = active
 
 
 def display_help():
@@ -90,165 +335,469 @@ def display_help():
         'V - water rise',
         'P - use of pymunk',
         'H - help',
+        '',
+        f'F - simulate {FAST_FORWARD_SECONDS} seconds at once',
+        'R - top-down ripple tank',
+        'B - rock benchmark',
     ]
     y = 0
     for i in _text:
         y += 20
-        text = font.render(i, True, 'white')
+        text = get_font().render(i, True, 'white')
         screen.blit(text, (25, y))
 
 
-class Ball:
-    def __init__(self, x, y):
-        self.x = x
-        self.y = y
-        self.height = randint(2, 10)
-        self.width = randint(5, 50 + 20)
-        self.dy = 0
-        self.spring: Union['WaterSpring', None] = None
-        self.next_spring: Union['WaterSpring', None] = None
-        self.rot = randint(0, 360)
-        self.rot = 0
-        self.gravity = 0.5
-        self.water_force = 2
-        self.on_water_surface = False
-
-    def update(self):
-        if self.spring:
-            if self.on_water_surface:
-                self.y = self.spring.height - self.height
-            else:
-                self.dy -= self.water_force
-                self.y += self.dy
-                if self.dy < 0 and self.y < self.spring.height:
-                    self.on_water_surface = True
-        else:
-            self.dy += self.gravity
-            self.y += self.dy
-
-    def draw(self, surf: pygame.Surface):
-        size = 50
+class FloatingObjects:
+    # balls held in arrays and updated together, they fall, dive into the water, come back up
+    # and then ride the surface between the two springs they are over
+    gravity = 0.5
+    water_force = 2
+    size = 50
+    push = 0.001  # how hard a floating ball presses into the springs for every px it sinks in
+    wake = 0.2  # part of the speed of a ball coming up that is given to the springs
+
+    def __init__(self, capacity=256):
+        self.count = 0
+        self.x = numpy.zeros(capacity)
+        self.y = numpy.zeros(capacity)
+        self.prev_y = numpy.zeros(capacity)
+        self.dy = numpy.zeros(capacity)
+        self.height = numpy.zeros(capacity)  # how deep the ball sinks in
+        self.in_water = numpy.zeros(capacity, dtype=bool)
+        self.on_water_surface = numpy.zeros(capacity, dtype=bool)
+
+    def __len__(self):
+        return self.count
+
+    @staticmethod
+    def grow(array, size):
+        if size <= len(array):
+            return array
+        new_array = numpy.zeros(max(size, 2 * len(array)), dtype=array.dtype)
+        new_array[:len(array)] = array
+        return new_array
+
+    def add(self, x, y):
+        i = self.count
+        for name in ['x', 'y', 'prev_y', 'dy', 'height', 'in_water', 'on_water_surface']:
+            setattr(self, name, self.grow(getattr(self, name), i + 1))
+        self.x[i] = x
+        self.y[i] = y
+        self.prev_y[i] = y
+        self.dy[i] = 0
+        self.height[i] = randint(2, 10)
+        self.in_water[i] = False
+        self.on_water_surface[i] = False
+        self.count += 1
+
+    def update(self, wave: 'Wave'):
+        n = self.count
+        x, y, dy = self.x[:n], self.y[:n], self.dy[:n]
+        in_water, on_surface = self.in_water[:n], self.on_water_surface[:n]
+        self.prev_y[:n] = y
+        # position between the two springs below every ball
+        pos = numpy.clip(x / wave.diff, 0, len(wave.x) - 1.001)
+        index = pos.astype(int)
+        frac = pos - index
+        surface = wave.height[index] * (1 - frac) + wave.height[index + 1] * frac
+
+        falling = ~in_water
+        dy[falling] += self.gravity
+        diving = in_water & ~on_surface
+        dy[diving] -= self.water_force
+        moving = ~on_surface
+        y[moving] += dy[moving]
+        surfacing = diving & (dy < 0) & (y < surface)
+        on_surface |= surfacing
+        y[on_surface] = surface[on_surface] - self.height[:n][on_surface]
+
+        # balls that just reached the water splash once
+        entered = falling & (y > wave.get_target_height())
+        in_water |= entered
+        numpy.add.at(wave.vel, index[entered], 2)
+        # balls coming up drag the water with them and floating balls press the springs down,
+        # both are shared by the two springs by how close they are
+        force = numpy.where(surfacing, self.wake * dy, 0)
+        force[on_surface] += self.push * self.height[:n][on_surface]
+        numpy.add.at(wave.vel, index, force * (1 - frac))
+        numpy.add.at(wave.vel, index + 1, force * frac)
+
+    def draw(self, surf: pygame.Surface, alpha=1.0):
+        n = self.count
+        if not n:
+            return
+        y = self.prev_y[:n] + (self.y[:n] - self.prev_y[:n]) * alpha
         if TEXTURE:
-            img = pygame.transform.scale(BALL_IMAGE, (size, size))
-            surf.blit(img, img.get_rect(center=(self.x, self.y)))
+            img = transform_cache.get(get_image('ball.png'), (self.size, self.size))
+            w, h = img.get_size()
+            surf.fblits([(img, (x - w / 2, y - h / 2)) for x, y in zip(self.x[:n].tolist(), y.tolist())])
         else:
-            pygame.draw.circle(surf, 'green', (self.x, self.y), size / 2)
+            for x, y in zip(self.x[:n].tolist(), y.tolist()):
+                pygame.draw.circle(surf, 'green', (x, y), self.size / 2)
 
 
 class WaterSpring:
-    def __init__(self, x=0, target_height=None):
-        if not target_height:
-            self.target_height = screen_height // 2 + 150
-        else:
-            self.target_height = target_height
-        self.dampening = 0.05  # adjust accordingly
-        self.tension = 0.01
-        self.height = self.target_height
-        self.vel = 0
-        self.x = x
+    # a single spring of a Wave, its values live in the arrays of the wave
+    def __init__(self, wave: 'Wave', index):
+        self.wave = wave
+        self.index = index
 
-    def update(self):
-        dh = self.target_height - self.height
-        if abs(dh) < 0.01:
-            self.height = self.target_height
-        self.vel += self.tension * dh - self.vel * self.dampening
-        self.height += self.vel
+    @property
+    def x(self):
+        return self.wave.x[self.index]
+
+    @property
+    def height(self):
+        return self.wave.height[self.index]
+
+    @height.setter
+    def height(self, value):
+        self.wave.height[self.index] = value
+
+    @property
+    def vel(self):
+        return self.wave.vel[self.index]
+
+    @vel.setter
+    def vel(self, value):
+        self.wave.vel[self.index] = value
+
+    @property
+    def target_height(self):
+        return self.wave.target_height[self.index]
+
+    @target_height.setter
+    def target_height(self, value):
+        self.wave.target_height[self.index] = value
 
     def draw(self, surf: pygame.Surface):
         pygame.draw.circle(surf, 'white', (self.x, self.height), 1)
 
 
 class Wave:
-    def __init__(self):
-        diff = 20
-        self.springs = [WaterSpring(x=i * diff + 0) for i in range(screen_width // diff + 2)]
-        self.points = []
+    def __init__(self, diff=20, width=screen_width, target_height=None):
+        if not target_height:
+            target_height = screen_height // 2 + 150
+        count = width // diff + 2
+        # every spring is an element of these arrays
+        self.x = numpy.arange(count, dtype=float) * diff
+        self.height = numpy.full(count, target_height, dtype=float)
+        self.prev_height = self.height.copy()  # heights before the last update
+        self.vel = numpy.zeros(count)
+        self.target_height = numpy.full(count, target_height, dtype=float)
+        self.dampening = 0.05  # adjust accordingly
+        self.tension = 0.01
+        self.spread = 0.1
+        self.spread_passes = 1  # more passes make the waves travel further every frame
+        self.springs = [WaterSpring(self, i) for i in range(count)]
         self.diff = diff
+        self.smoother = None  # created the first time SMOOTH is used
+        # polygon vertices, the surface followed by the two bottom corners
+        self.raw_points = self.create_vertex_buffer(self.x)
+        self.smooth_points = None
+        self.points = self.raw_points
+        self.draw_points = self.points  # points with the flat parts left out
 
     def get_spring_index_for_x_pos(self, x):
         return int(x // self.diff)
 
     def get_target_height(self):
-        return self.springs[0].target_height
+        return self.target_height[0]
 
     def set_target_height(self, height):
-        for i in self.springs:
-            i.target_height = height
+        self.target_height[:] = height
 
     def add_volume(self, volume):
         height = volume / screen_width
         self.set_target_height(self.get_target_height() - height)
 
     def update(self):
-        for i in self.springs:
-            i.update()
+        self.prev_height[:] = self.height
+        dh = self.target_height - self.height
+        settled = numpy.abs(dh) < 0.01
+        self.height[settled] = self.target_height[settled]
+        self.vel += self.tension * dh - self.vel * self.dampening
+        self.height += self.vel
         self.spread_wave()
-        self.points = [Point(i.x, i.height) for i in self.springs]
+
+    @staticmethod
+    def create_vertex_buffer(x):
+        points = numpy.zeros((len(x) + 2, 2))
+        points[:-2, 0] = x
+        points[-2:] = [(screen_width, screen_height), (0, screen_height)]
+        return points
+
+    def update_points(self, alpha=1.0):
+        # the surface is drawn alpha of the way between the last two updates
+        height = self.prev_height + (self.height - self.prev_height) * alpha
         if SMOOTH:
-            self.points = get_curve(self.points)
-        self.points.extend([Point(screen_width, screen_height), Point(0, screen_height)])
+            if not self.smoother:
+                start = time.perf_counter()
+                self.smoother = CurveSmoother(self.x)
+                startup_phase('spline basis', start)
+                self.smooth_points = self.create_vertex_buffer(self.smoother.x_new)
+            self.smooth_points[:-2, 1] = self.smoother.get_heights(height)
+            self.points = self.smooth_points
+        else:
+            self.raw_points[:-2, 1] = height
+            self.points = self.raw_points
+        self.draw_points = self.get_lod_points()
+
+    def get_lod_points(self):
+        y = self.points[:-2, 1]
+        keep = numpy.ones(len(y), dtype=bool)
+        # second difference, how much the surface bends at every vertex
+        keep[1:-1] = numpy.abs(y[:-2] - 2 * y[1:-1] + y[2:]) > LOD_TOLERANCE
+        keep[::LOD_MAX_GAP] = True
+        keep[-1] = True
+        return numpy.concatenate([self.points[:-2][keep], self.points[-2:]])
+
+    def get_rect(self):
+        # the part of the screen covered by the water
+        top = math.floor(self.draw_points[:, 1].min())
+        return pygame.Rect(0, top, screen_width, screen_height - top).clip(screen.get_rect())
 
     def draw(self, surf: pygame.Surface):
-        pygame.draw.polygon(surf, (0, 0, 255, 50), self.points)
+        pygame.draw.polygon(surf, (0, 0, 255, 50), self.draw_points)
 
     def draw_line(self, surf: pygame.Surface):
-        pygame.draw.lines(surf, 'white', False, self.points[:-2], 5)
+        pygame.draw.lines(surf, 'white', False, self.draw_points[:-2], 5)
 
     def spread_wave(self):
-        spread = 0.1
-        for i in range(len(self.springs)):
-            if i > 0:
-                self.springs[i - 1].vel += spread * (self.springs[i].height - self.springs[i - 1].height)
-            try:
-                self.springs[i + 1].vel += spread * (self.springs[i].height - self.springs[i + 1].height)
-            except IndexError:
-                pass
+        for i in range(self.spread_passes):
+            # every spring pulls both of its neighbours towards its own height
+            delta = self.spread * numpy.diff(self.height)
+            self.vel[:-1] += delta
+            self.vel[1:] -= delta
+            if i < self.spread_passes - 1:
+                # the next pass sees the wave that already moved over to the neighbours
+                self.height[:-1] += delta
+                self.height[1:] -= delta
 
     def splash(self, index, vel):
         try:
-            self.springs[index].vel += vel
+            self.vel[index] += vel
         except IndexError:
             pass
 
 
-def get_curve(points):
-    x_new = numpy.arange(points[0].x, points[-1].x, 1)
-    x = numpy.array([i.x for i in points[:-1]])
-    y = numpy.array([i.y for i in points[:-1]])
-    f = interp1d(x, y, kind='cubic', fill_value='extrapolate')
-    y_new = f(x_new)
-    x1 = list(x_new)
-    y1 = list(y_new)
-    points = [Point(x1[i], y1[i]) for i in range(len(x1))]
-    return points
+class CurveSmoother:
+    # the cubic spline through the springs is linear in their heights and the x positions never change,
+    # so the curve is a single matrix product with a basis that is computed once
+    def __init__(self, x):
+        self.x_new = numpy.arange(x[0], x[-1], 1)
+        self.basis = self.load_basis(x) if SPLINE_CACHE_FILE else None
+        if self.basis is None:
+            from scipy.interpolate import interp1d
+            # like before, the last spring is left out and the curve is extrapolated up to it
+            basis = interp1d(x[:-1], numpy.eye(len(x) - 1), kind='cubic', axis=0, fill_value='extrapolate')
+            self.basis = basis(self.x_new)
+            if SPLINE_CACHE_FILE:
+                self.save_basis(x, self.basis)
+
+    @staticmethod
+    def load_basis(x):
+        try:
+            with numpy.load(SPLINE_CACHE_FILE) as data:
+                if numpy.array_equal(data['x'], x):
+                    return data['basis']
+        except (OSError, KeyError, ValueError, EOFError, zipfile.BadZipFile):
+            # a missing, old or broken cache is computed again
+            pass
+        return None
+
+    @staticmethod
+    def save_basis(x, basis):
+        # written next to the old cache and swapped in, so a save that is cut off leaves no broken file
+        temp_path = SPLINE_CACHE_FILE + '.tmp'
+        try:
+            with open(temp_path, 'wb') as f:
+                numpy.savez_compressed(f, x=x, basis=basis.astype(numpy.float32))  # float32 is plenty for pixels
+            os.replace(temp_path, SPLINE_CACHE_FILE)
+        except OSError:
+            # a read-only folder or a full disk only costs the cache, the computed basis is used anyway
+            print('Could not save the spline cache')
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+
+    def get_heights(self, heights):
+        return self.basis @ heights[:-1]
+
+
+class RippleTank:
+    # the damped wave equation on a grid, every cell is accelerated towards the average of its four neighbours
+    def __init__(self, width, height):
+        self.size = (width, height)
+        self.height = numpy.zeros(self.size, dtype=numpy.float32)
+        self.vel = numpy.zeros(self.size, dtype=numpy.float32)
+        self.laplacian = numpy.zeros((width - 2, height - 2), dtype=numpy.float32)
+        self.scratch = numpy.zeros((width - 2, height - 2), dtype=numpy.float32)
+        self.shade = numpy.full(self.size, 128, dtype=numpy.float32)  # the border is never lit
+        self.pixels = numpy.zeros(self.size, dtype=numpy.uint8)
+        # the shading is a palette index, dark blue for slopes facing away from the light up to white
+        self.surf = pygame.Surface(self.size, depth=8)
+        self.surf.set_palette([(i * i // 255, 60 + i * 195 // 255, 120 + i * 135 // 255) for i in range(256)])
+        scale = screen_height / height
+        self.rect = pygame.Rect(0, 0, round(width * scale), screen_height)
+        self.rect.centerx = screen_width // 2
+        self.scaled = pygame.Surface(self.rect.size, depth=8)
+        self.scaled.set_palette(self.surf.get_palette())
 
+    def update(self):
+        # all the operations write into the arrays created in __init__, nothing is allocated every step
+        h = self.height
+        lap = self.laplacian
+        numpy.add(h[:-2, 1:-1], h[2:, 1:-1], out=lap)
+        lap += h[1:-1, :-2]
+        lap += h[1:-1, 2:]
+        numpy.multiply(h[1:-1, 1:-1], 4, out=self.scratch)
+        lap -= self.scratch
+        lap *= RIPPLE_SPEED
+        # the border cells never move, the waves bounce off the sides
+        self.vel[1:-1, 1:-1] += lap
+        self.vel *= 1 - RIPPLE_DAMPENING
+        h += self.vel
+
+    def to_grid(self, pos):
+        x, y = pos
+        return ((x - self.rect.x) * self.size[0] / self.rect.width,
+                (y - self.rect.y) * self.size[1] / self.rect.height)
+
+    def splash(self, pos, radius, vel):
+        # pushes a round bump into the water at a screen position, like Wave.splash for a single spring
+        x, y = self.to_grid(pos)
+        r = max(radius * self.size[1] / self.rect.height, 1)
+        x1, x2 = max(int(x - r), 1), min(int(x + r) + 1, self.size[0] - 1)
+        y1, y2 = max(int(y - r), 1), min(int(y + r) + 1, self.size[1] - 1)
+        if x1 >= x2 or y1 >= y2:
+            return
+        dx = numpy.arange(x1, x2)[:, None] - x
+        dy = numpy.arange(y1, y2)[None, :] - y
+        d = numpy.minimum(numpy.sqrt(dx * dx + dy * dy) / r, 1)
+        # smooth falloff to the edge, a sharp edge leaves noise behind
+        self.vel[x1:x2, y1:y2] += vel * (numpy.cos(d * math.pi) + 1) / 2
 
-def create_walls():
+    def draw(self, surf: pygame.Surface):
+        # light from the top left, the brightness of a cell is the slope of the water there
+        h = self.height
+        shade = self.shade[1:-1, 1:-1]
+        numpy.subtract(h[:-2, 1:-1], h[2:, 1:-1], out=shade)
+        shade += h[1:-1, :-2]
+        shade -= h[1:-1, 2:]
+        shade *= RIPPLE_SHADING
+        shade += 128
+        numpy.clip(self.shade, 0, 255, out=self.shade)
+        self.pixels[...] = self.shade
+        pygame.surfarray.blit_array(self.surf, self.pixels)
+        pygame.transform.scale(self.surf, self.rect.size, self.scaled)
+        surf.blit(self.scaled, self.rect)
+
+
+def create_ripple_tank():
+    # the grid and its surfaces are only created the first time the ripple tank is shown
+    start = time.perf_counter()
+    tank = RippleTank(*RIPPLE_SIZE)
+    startup_phase('ripple tank', start)
+    return tank
+
+
+def create_walls(_space):
     base = pymunk.Body(mass=10 ** 5, moment=0, body_type=pymunk.Body.STATIC)
     base.position = (screen_width // 2, screen_height + 25)
     base_shape = pymunk.Poly.create_box(base, (screen_width, 50))
     base_shape.friction = 0.2
-    space.add(base, base_shape)
+    _space.add(base, base_shape)
 
     wall_left = pymunk.Body(mass=10 ** 5, moment=0, body_type=pymunk.Body.STATIC)
     wall_left.position = (-50, screen_height // 2)
     wall_left_shape = pymunk.Poly.create_box(wall_left, (100, screen_height))
-    space.add(wall_left, wall_left_shape)
+    _space.add(wall_left, wall_left_shape)
 
     wall_right = pymunk.Body(mass=10 ** 5, moment=0, body_type=pymunk.Body.STATIC)
     wall_right.position = (screen_width + 50, screen_height // 2)
     wall_right_shape = pymunk.Poly.create_box(wall_right, (100, screen_height))
-    space.add(wall_right, wall_right_shape)
+    _space.add(wall_right, wall_right_shape)
+
+
+def benchmark_rocks(counts=(250, 500, 1000), seconds=4):
+    # frame time against the number of rocks, with and without MANY_ROCKS
+    # the rocks are dropped and simulated for a while, then the frame time is measured over one second
+    # the game is frozen while it runs, every measurement is printed as soon as it is done
+    global MANY_ROCKS
+    load_pymunk()
+    many_rocks = MANY_ROCKS
+    surf = pygame.Surface(screen.get_size())
+    measured_frames = round(1 / SIM_DT)
+    print(f'rock benchmark, {len(counts) * 2} runs of {seconds} simulated seconds', flush=True)
+    for count in counts:
+        results = []
+        for mode in [False, True]:
+            MANY_ROCKS = mode
+            _space = create_space()
+            create_walls(_space)
+            rubble = Rubble()
+            rocks = [create_rock(_space, 30 + (i * 47) % (screen_width - 60), -60 * (i // 25)) for i in range(count)]
+            frames = round(seconds / SIM_DT)
+            for frame in range(frames):
+                if frame == frames - measured_frames:
+                    start = time.perf_counter()
+                for i in rocks:
+                    i.body.prev_position = i.body.position
+                    i.body.prev_angle = i.body.angle
+                _space.step(SIM_DT)
+                if MANY_ROCKS:
+                    retire_rocks(rocks, _space, rubble)
+                    rubble.draw(surf)
+                draw_rocks(rocks, surf)
+            results.append(((time.perf_counter() - start) / measured_frames * 1000, len(rocks)))
+            print(f'{count} rocks, MANY_ROCKS = {mode}: {results[-1][0]:.2f} ms per frame', flush=True)
+        (plain, _), (many, moving) = results
+        print(f'{count} rocks: {plain:.2f} ms per frame, {many:.2f} ms with MANY_ROCKS ({moving} still moving)', flush=True)
+    MANY_ROCKS = many_rocks
+
+
+def step_simulation(wave: Wave, objects, floating_objects: FloatingObjects, tank=None, rubble=None):
+    # advances everything by SIM_DT
+    if RIPPLE_TANK:
+        tank.update()
+        return
+    if USE_PYMUNK:
+        for i in objects:
+            i.body.prev_position = i.body.position
+            i.body.prev_angle = i.body.angle
+        for _ in range(PHYSICS_SUBSTEPS):
+            space.step(SIM_DT / PHYSICS_SUBSTEPS)
+        if MANY_ROCKS:
+            retire_rocks(objects, space, rubble)
+    floating_objects.update(wave)
+    wave.update()
+
+
+def run_simulation(wave: Wave, objects, floating_objects: FloatingObjects, seconds, tank=None, rubble=None):
+    # runs the simulation without drawing, as fast as the machine allows
+    for _ in range(round(seconds / SIM_DT)):
+        step_simulation(wave, objects, floating_objects, tank, rubble)
+
+
+def show_frame():
+    pygame.display.update()
+    if not startup_done:
+        print_startup_report()
 
 
 def main_game():
-    global USE_PYMUNK, SMOOTH, VOLUME_RISE, TEXTURE, DISPLAY_HELP
-    if USE_PYMUNK:
-        create_walls()
+    global USE_PYMUNK, SMOOTH, VOLUME_RISE, TEXTURE, DISPLAY_HELP, RIPPLE_TANK
     wave = Wave()
+    tank = create_ripple_tank() if RIPPLE_TANK else None
+    rubble = Rubble()
+    if USE_PYMUNK:
+        enable_pymunk(wave)
     s = pygame.Surface(screen.get_size(), pygame.SRCALPHA).convert_alpha()
-    objects: list[pymunk.Circle] = []
-    floating_objects: list[Ball] = []
+    objects = []
+    floating_objects = FloatingObjects()
+    accumulator = 0  # simulation time that is still to be stepped
 
     while True:
         events = pygame.event.get()
@@ -264,50 +813,70 @@ def main_game():
                     VOLUME_RISE = not VOLUME_RISE
                 if e.key == pygame.K_p:
                     USE_PYMUNK = not USE_PYMUNK
+                    if USE_PYMUNK:
+                        enable_pymunk(wave)
                 if e.key == pygame.K_t:
                     TEXTURE = not TEXTURE
+                    rubble.redraw()
+                if e.key == pygame.K_b:
+                    benchmark_rocks()
                 if e.key == pygame.K_h:
                     DISPLAY_HELP = not DISPLAY_HELP
-            if e.type == pygame.MOUSEBUTTONDOWN:
+                if e.key == pygame.K_f:
+                    run_simulation(wave, objects, floating_objects, FAST_FORWARD_SECONDS, tank, rubble)
+                if e.key == pygame.K_r:
+                    RIPPLE_TANK = not RIPPLE_TANK
+                    if RIPPLE_TANK and tank is None:
+                        tank = create_ripple_tank()
+            if e.type == pygame.MOUSEBUTTONDOWN and RIPPLE_TANK:
+                # seen from the top, rocks and balls disturb the water where they are dropped
+                if e.button == 1:
+                    radius = randint(2, 10) * 5  # same sizes as the rocks of create_rock
+                    tank.splash(e.pos, radius, radius)
+                if e.button == 3:
+                    tank.splash(e.pos, 25, 2)
+            elif e.type == pygame.MOUSEBUTTONDOWN:
                 if e.button == 1 and USE_PYMUNK:
                     mx, my = pygame.mouse.get_pos()
                     rock = create_rock(space, mx, my)
                     objects.append(rock)
+                    if rock.body.position.y - rock.radius > wave.get_target_height():
+                        # dropped completely under water, it never crosses the sensor
+                        splash_rock(rock, wave)
                 if e.button == 3:
                     mx, my = pygame.mouse.get_pos()
-                    floating_objects.append(Ball(mx, my))
-        if USE_PYMUNK:
-            space.step(1 / FPS)
+                    floating_objects.add(mx, my)
+        steps = 0
+        while accumulator >= SIM_DT and steps < MAX_SIM_STEPS:
+            step_simulation(wave, objects, floating_objects, tank, rubble)
+            accumulator -= SIM_DT
+            steps += 1
+        if steps == MAX_SIM_STEPS:
+            accumulator %= SIM_DT  # too far behind, the simulation slows down instead of spiralling
+        alpha = accumulator / SIM_DT
+        if RIPPLE_TANK:
+            screen.fill('black')
+            tank.draw(screen)
+            if DISPLAY_HELP:
+                display_help()
+            show_frame()
+            accumulator += clock.tick(FPS) / 1000
+            continue
         screen.fill('black')
-        s.fill(0)
-        for i in objects:
-            if not i.body.splashed:
-                if i.body.position.y + i.radius > wave.get_target_height():
-                    i.body.splashed = True
-                    wave.splash(index=wave.get_spring_index_for_x_pos(i.body.position.x), vel=i.radius)
-                    if VOLUME_RISE:
-                        wave.add_volume(i.radius ** 2 * math.pi)
-            draw_rock(i, screen)
-        for i in floating_objects:
-            i.update()
-            i.draw(screen)
-            index = wave.get_spring_index_for_x_pos(i.x)
-            if i.y > wave.get_target_height():
-                if not i.spring:
-                    i.spring = wave.springs[index]
-                    try:
-                        i.next_spring = wave.springs[index + 1]
-                    except IndexError:
-                        pass
-                    wave.splash(index, 2)
-        wave.update()
+        rubble.draw(screen)
+        draw_rocks(objects, screen, alpha)
+        floating_objects.draw(screen, alpha)
+        wave.update_points(alpha)
+        # the translucent layer is only cleared and blitted where the water is
+        water_rect = wave.get_rect()
+        s.fill(0, water_rect)
         wave.draw(s)
-        screen.blit(s, (0, 0))
+        screen.blit(s, water_rect, water_rect)
         wave.draw_line(screen)
         if DISPLAY_HELP:
             display_help()
-        pygame.display.update()
-        clock.tick(FPS)
+        show_frame()
+        accumulator += clock.tick(FPS) / 1000
         # print(clock.get_fps())
 
 